@@ -1,34 +1,131 @@
-import tempfile, subprocess, os
+import tempfile, subprocess, os, mmap, hashlib, threading, re
+from functools import lru_cache
+from contextlib import contextmanager
+from io import BytesIO
+from cachetools import LRUCache
 from weasyprint import HTML
-from jinja2 import Template
+from weasyprint.text.fonts import FontConfiguration
+from jinja2 import Environment
+
+from app.office_pool import pool
+
+# Directorio para los archivos intermedios de LibreOffice; conviene que sea
+# un tmpfs para que la entrada y la salida no toquen disco
+LO_TMPDIR = os.environ.get("LO_TMPDIR", tempfile.gettempdir())
+
+# Configuración de fuentes reutilizada entre renders del mismo hilo, para no
+# reconstruirla en cada llamada a write_pdf. Solo se comparte con documentos
+# que no pueden declarar fuentes propias: WeasyPrint indexa las @font-face por
+# familia/estilo (no por src), así que una fuente de un documento acabaría
+# usándose en otro
+_font_configs = threading.local()
+_FONT_FACE_RE = re.compile(r"@font-face|@import|<link", re.IGNORECASE)
+
+# Caché en proceso de PDFs ya renderizados, indexada por el hash del HTML y
+# acotada en bytes (cada proceso de render tiene la suya)
+PDF_CACHE_MAX_BYTES = int(os.environ.get("PDF_CACHE_MAX_BYTES", "33554432"))  # 32MB
+_pdf_cache = LRUCache(maxsize=PDF_CACHE_MAX_BYTES, getsizeof=len) if PDF_CACHE_MAX_BYTES > 0 else None
+_pdf_cache_lock = threading.Lock()
+# Recursos que WeasyPrint descarga al renderizar; un PDF que depende de ellos
+# puede cambiar sin que cambie el HTML, así que no se cachea
+_EXTERNAL_RESOURCE_RE = re.compile(
+    r"""(?:\b(?:src|srcset|href)\s*=\s*|url\(\s*)["']?\s*(?:https?:|file:|//)|@import""",
+    re.IGNORECASE
+)
+
+# Entorno Jinja compartido; las plantillas compiladas se cachean por su fuente
+_jinja_env = Environment(autoescape=True)
+
+
+def start_office_pool():
+    """Arranca los listeners de LibreOffice del pool y el hilo que los vigila."""
+    pool.start()
+
+
+def html_cache_key(html_content: str) -> str:
+    """Hash del HTML con el que se indexan los PDFs cacheados."""
+    return hashlib.blake2b(html_content.encode(), digest_size=16).hexdigest()
+
+def html_is_cacheable(html_content: str) -> bool:
+    """Un PDF solo se cachea si el HTML no carga recursos externos."""
+    return _EXTERNAL_RESOURCE_RE.search(html_content) is None
+
+def _font_config_for(html_content: str) -> FontConfiguration:
+    """Configuración de fuentes del hilo, o una nueva si el HTML trae fuentes."""
+    if _FONT_FACE_RE.search(html_content):
+        return FontConfiguration()
+    font_config = getattr(_font_configs, "shared", None)
+    if font_config is None:
+        font_config = _font_configs.shared = FontConfiguration()
+    return font_config
+
+def render_html(html_content: str) -> bytes:
+    """Renderiza HTML a PDF sin pasar por la caché en proceso."""
+    buf = BytesIO()
+    HTML(string=html_content).write_pdf(target=buf, font_config=_font_config_for(html_content))
+    return buf.getvalue()
 
 def html_to_pdf_bytes(html_content: str) -> bytes:
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-        tmp_path = tmp.name
-    try:
-        HTML(string=html_content).write_pdf(tmp_path)
-        with open(tmp_path, "rb") as f:
-            data = f.read()
-    finally:
-        try: os.remove(tmp_path)
-        except Exception: pass
-    return data
-
-def libreoffice_convert_bytes(input_bytes: bytes, filename: str) -> bytes:
-    ext = os.path.splitext(filename)[1].lower()
-    with tempfile.TemporaryDirectory() as tmpdir:
+    if _pdf_cache is None or not html_is_cacheable(html_content):
+        return render_html(html_content)
+    key = html_cache_key(html_content)
+    with _pdf_cache_lock:
+        pdf = _pdf_cache.get(key)
+    if pdf is None:
+        pdf = render_html(html_content)
+        # LRUCache rechaza valores mayores que todo el presupuesto
+        if len(pdf) <= PDF_CACHE_MAX_BYTES:
+            with _pdf_cache_lock:
+                _pdf_cache[key] = pdf
+    return pdf
+
+@contextmanager
+def libreoffice_convert_mmap(input_bytes: bytes, filename: str, listener=None):
+    """
+    Convierte con LibreOffice y expone el PDF generado como un memoryview
+    sobre un mmap del archivo de salida, válido solo dentro del bloque with.
+    Si se indica `listener`, la conversión espera a ese listener del pool.
+    """
+    with tempfile.TemporaryDirectory(dir=LO_TMPDIR) as tmpdir:
         input_path = os.path.join(tmpdir, filename)
         with open(input_path, "wb") as f:
             f.write(input_bytes)
-        subprocess.run([
-            "libreoffice", "--headless", "--convert-to", "pdf", input_path, "--outdir", tmpdir
-        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120)
+        with pool.checkout(listener) as listener:
+            subprocess.run([
+                "unoconv", "--no-launch", "--connection", listener.connection,
+                "-f", "pdf", "-o", tmpdir, input_path
+            ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120)
         pdf_candidates = [f for f in os.listdir(tmpdir) if f.lower().endswith(".pdf")]
         if not pdf_candidates: raise RuntimeError("No se generó el PDF")
         pdf_path = os.path.join(tmpdir, pdf_candidates[0])
-        with open(pdf_path, "rb") as f:
-            return f.read()
+        if os.path.getsize(pdf_path) == 0: raise RuntimeError("El PDF generado está vacío")
+        # Servir la salida desde la caché de páginas del kernel vía mmap
+        with open(pdf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                yield view
+            finally:
+                view.release()
+
+def libreoffice_convert_bytes(input_bytes: bytes, filename: str, listener=None) -> bytes:
+    with libreoffice_convert_mmap(input_bytes, filename, listener) as pdf:
+        return bytes(pdf)
+
+def warm_up_html():
+    """Renderiza un HTML mínimo para pagar la inicialización de WeasyPrint al arrancar."""
+    render_html("<p>warm</p>")
+
+def warm_up_office():
+    """Hace una conversión de prueba en cada listener del pool de LibreOffice."""
+    # checkout() sin argumento daría siempre el primer listener libre, así
+    # que se apunta a cada uno explícitamente
+    for listener in pool.listeners:
+        libreoffice_convert_bytes(b"warm", "warm.txt", listener)
+
+@lru_cache(maxsize=512)
+def _compile_template(template_str: str):
+    return _jinja_env.from_string(template_str)
 
 def render_template(template_str: str, context: dict | None) -> str:
-    tmpl = Template(template_str)
+    tmpl = _compile_template(template_str)
     return tmpl.render(**(context or {}))
@@ -1,24 +1,64 @@
 import os
-import base64
-import json
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
-from fastapi.responses import StreamingResponse, JSONResponse
-from io import BytesIO
-from weasyprint import HTML
-import redis
+import asyncio
+import pybase64
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Query
+from fastapi.responses import Response, ORJSONResponse
+from starlette.concurrency import run_in_threadpool
 from rq import Queue
+from rq.job import Job
 from typing import Optional
+from uuid import uuid4
 
-app = FastAPI(title="PDF Service")
+from app.converter import html_to_pdf_bytes, warm_up_html
+from app.redis_pool import make_redis
+
+app = FastAPI(title="PDF Service", default_response_class=ORJSONResponse)
 
 # Configuración desde variables de entorno
 REDIS_URL = os.environ.get("REDIS_URL", "redis://redis:6379/0")
 MAX_FILE_SIZE = int(os.environ.get("MAX_FILE_SIZE", "5242880"))  # 5MB por defecto
+JOB_TTL = int(os.environ.get("JOB_TTL_SECONDS", "3600"))
+MAX_BULK_FILES = int(os.environ.get("MAX_BULK_FILES", "20"))
+MAX_BULK_SIZE = int(os.environ.get("MAX_BULK_SIZE", "20971520"))  # 20MB por defecto
+MAX_JOB_IDS = int(os.environ.get("MAX_JOB_IDS", "100"))
+# Procesos dedicados a renderizar /generate-pdf (0 = usar el threadpool). Por
+# defecto pocos: cada uno carga WeasyPrint y su propia caché de PDFs, y
+# sched_getaffinity respeta los CPUs asignados al contenedor
+_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", str(min(4, _CPUS))))
 
-# Conexión a Redis para cola de jobs
-r = redis.Redis.from_url(REDIS_URL)
+# Conexión a Redis (pool compartido) para cola de jobs
+r = make_redis(REDIS_URL)
 q = Queue("pdf_jobs", connection=r)
 
+# Pool de procesos para renders síncronos, creado al iniciar la app
+render_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _new_render_pool() -> ProcessPoolExecutor:
+    # Cada proceso del pool inicializa WeasyPrint al arrancar
+    return ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=warm_up_html)
+
+
+@app.on_event("startup")
+async def start_render_pool():
+    global render_pool
+    if RENDER_WORKERS > 0:
+        # El primer submit fuerza que los procesos se creen antes de la
+        # primera petición real
+        render_pool = _new_render_pool()
+        await asyncio.get_running_loop().run_in_executor(render_pool, warm_up_html)
+    else:
+        await run_in_threadpool(warm_up_html)
+
+
+@app.on_event("shutdown")
+async def stop_render_pool():
+    if render_pool is not None:
+        render_pool.shutdown(wait=False, cancel_futures=True)
+
 
 @app.get("/")
 async def root():
@@ -30,7 +70,9 @@ async def root():
             "health": "/health",
             "sync_conversion": "/generate-pdf",
             "async_conversion": "/generate-pdf-async",
+            "async_bulk_conversion": "/generate-pdf-async-bulk",
             "job_status": "/job-status/{job_id}",
+            "jobs_status": "/jobs?ids={job_id}&ids={job_id}",
             "job_result": "/job-result/{job_id}"
         }
     }
@@ -43,12 +85,31 @@ async def health_check():
         r.ping()
         return {"status": "healthy", "redis": "connected"}
     except Exception as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=503,
             content={"status": "unhealthy", "redis": "disconnected", "error": str(e)}
         )
 
 
+async def _render_in_pool(html_content: str) -> bytes:
+    """
+    Renderiza en el pool de procesos. Si un proceso de render muere (OOM,
+    segfault de pango/cairo) el pool queda roto para siempre, así que se
+    recrea y se reintenta una vez.
+    """
+    global render_pool
+    loop = asyncio.get_running_loop()
+    pool = render_pool
+    try:
+        return await loop.run_in_executor(pool, html_to_pdf_bytes, html_content)
+    except BrokenProcessPool:
+        # Solo la primera petición que lo detecta recrea el pool
+        if render_pool is pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            render_pool = _new_render_pool()
+        return await loop.run_in_executor(render_pool, html_to_pdf_bytes, html_content)
+
+
 @app.post("/generate-pdf")
 async def generate_pdf(payload: dict):
     """
@@ -56,16 +117,90 @@ async def generate_pdf(payload: dict):
     Útil para conversiones rápidas y pequeñas.
     """
     html_content = payload.get("html", "<p>No HTML provided</p>")
-    pdf_file = BytesIO()
-    HTML(string=html_content).write_pdf(target=pdf_file)
-    pdf_file.seek(0)
-    return StreamingResponse(
-        pdf_file,
+    # Renderizar fuera del event loop para no bloquear otras peticiones; con
+    # el pool de procesos varios renders corren en paralelo sin el GIL
+    if render_pool is not None:
+        pdf_bytes = await _render_in_pool(html_content)
+    else:
+        pdf_bytes = await run_in_threadpool(html_to_pdf_bytes, html_content)
+    return Response(
+        content=pdf_bytes,
         media_type="application/pdf",
         headers={"Content-Disposition": "attachment; filename=document.pdf"}
     )
 
 
+def _file_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"Archivo demasiado grande. Máximo permitido: {MAX_FILE_SIZE} bytes"
+    )
+
+
+async def _read_upload(file: UploadFile) -> bytes:
+    """
+    Lee un archivo subido validando el tamaño máximo permitido.
+    Starlette ya ha volcado el cuerpo a disco, así que con el tamaño
+    declarado se rechaza sin cargar nada en memoria.
+    """
+    if file.size is not None and file.size > MAX_FILE_SIZE:
+        raise _file_too_large()
+    
+    # Una sola lectura, acotada por si el tamaño no viene declarado
+    content = await file.read(MAX_FILE_SIZE + 1)
+    if len(content) > MAX_FILE_SIZE:
+        raise _file_too_large()
+    return content
+
+
+def _build_payload(filename: str, input_key: str, as_base64: bool) -> dict:
+    """
+    Prepara el payload que recibe el worker. El contenido del archivo no
+    viaja en el job: se guarda aparte en Redis bajo `input_key`.
+    """
+    return {
+        "filename": filename,
+        "input_key": input_key,
+        "as_base64": as_base64
+    }
+
+
+def _enqueue_uploads(uploads: list, as_base64: bool) -> list:
+    """
+    Guarda el contenido de cada (job_id, filename, content) en Redis y
+    encola sus jobs, todo en un único pipeline. El job y su entrada
+    comparten TTL para que un job que espere en la cola no se quede sin
+    contenido.
+    """
+    with r.pipeline() as pipe:
+        job_datas = []
+        for job_id, filename, content in uploads:
+            input_key = f"pdf_input:{job_id}"
+            pipe.set(input_key, content, ex=JOB_TTL)
+            job_datas.append(Queue.prepare_data(
+                'worker.worker.process_job',
+                args=(_build_payload(filename, input_key, as_base64),),
+                job_id=job_id,
+                ttl=JOB_TTL,
+                result_ttl=JOB_TTL,
+                failure_ttl=JOB_TTL
+            ))
+        # enqueue_many no abre MULTI, así que puede compartir el pipeline
+        # con los SET anteriores (enqueue sí lo hace y fallaría)
+        jobs = q.enqueue_many(job_datas, pipeline=pipe)
+        pipe.execute()
+    return jobs
+
+
+def _job_response(job_id: str, filename: str) -> dict:
+    return {
+        "job_id": job_id,
+        "filename": filename,
+        "status_url": f"/job-status/{job_id}",
+        "result_url": f"/job-result/{job_id}"
+    }
+
+
 @app.post("/generate-pdf-async")
 async def generate_pdf_async(
     file: UploadFile = File(...),
@@ -76,56 +211,128 @@ async def generate_pdf_async(
     Soporta HTML, DOCX, ODT, y otros formatos compatibles con LibreOffice.
     """
     # Validar tamaño del archivo
-    content = await file.read()
-    if len(content) > MAX_FILE_SIZE:
+    content = await _read_upload(file)
+    
+    # Guardar el contenido y encolar el job en Redis en un único pipeline
+    job, = _enqueue_uploads([(str(uuid4()), file.filename, content)], as_base64)
+    
+    return {
+        "message": "Job encolado exitosamente",
+        **_job_response(job.get_id(), file.filename)
+    }
+
+
+@app.post("/generate-pdf-async-bulk")
+async def generate_pdf_async_bulk(
+    files: list[UploadFile] = File(...),
+    as_base64: bool = Form(False)
+):
+    """
+    Encola varias conversiones PDF de una sola vez.
+    Todos los jobs se escriben en Redis en un único pipeline.
+    """
+    # Validar todos los archivos antes de encolar ninguno
+    if len(files) > MAX_BULK_FILES:
         raise HTTPException(
             status_code=413,
-            detail=f"Archivo demasiado grande. Máximo permitido: {MAX_FILE_SIZE} bytes"
+            detail=f"Demasiados archivos. Máximo permitido: {MAX_BULK_FILES}"
         )
+    bulk_too_large = HTTPException(
+        status_code=413,
+        detail=f"Lote demasiado grande. Máximo permitido: {MAX_BULK_SIZE} bytes"
+    )
+    if sum(file.size or 0 for file in files) > MAX_BULK_SIZE:
+        raise bulk_too_large
     
-    # Preparar payload para el worker
-    payload = {
-        "filename": file.filename,
-        "content_b64": base64.b64encode(content).decode(),
-        "as_base64": as_base64
-    }
+    uploads = []
+    total = 0
+    for file in files:
+        content = await _read_upload(file)
+        total += len(content)
+        if total > MAX_BULK_SIZE:
+            raise bulk_too_large
+        uploads.append((str(uuid4()), file.filename, content))
     
-    # Encolar job en Redis
-    job = q.enqueue(
-        'worker.worker.process_job',
-        payload,
-        job_id=None,
-        result_ttl=int(os.environ.get("JOB_TTL_SECONDS", "3600")),
-        failure_ttl=int(os.environ.get("JOB_TTL_SECONDS", "3600"))
-    )
+    jobs = _enqueue_uploads(uploads, as_base64)
     
     return {
-        "message": "Job encolado exitosamente",
-        "job_id": job.get_id(),
-        "filename": file.filename,
-        "status_url": f"/job-status/{job.get_id()}",
-        "result_url": f"/job-result/{job.get_id()}"
+        "message": f"{len(jobs)} jobs encolados exitosamente",
+        "jobs": [
+            _job_response(job.get_id(), filename)
+            for job, (_, filename, _) in zip(jobs, uploads)
+        ]
     }
 
 
+# Campos de metadata del hash pdf:{job_id} (todo salvo el PDF)
+META_FIELDS = ("status", "filename", "as_base64", "size_bytes", "error", "trace")
+
+
+def _decode_meta(fields: dict) -> dict:
+    """Convierte los campos crudos del hash de un job en su metadata."""
+    meta = {
+        name.decode() if isinstance(name, bytes) else name: value.decode()
+        for name, value in fields.items()
+        if value is not None and name not in ("pdf", b"pdf")
+    }
+    if "as_base64" in meta:
+        meta["as_base64"] = meta["as_base64"] == "1"
+    if "size_bytes" in meta:
+        meta["size_bytes"] = int(meta["size_bytes"])
+    return meta
+
+
 @app.get("/job-status/{job_id}")
 async def get_job_status(job_id: str):
     """
     Consulta el estado de un job asíncrono.
     """
-    meta_key = f"pdf_meta:{job_id}"
-    meta_data = r.get(meta_key)
+    values = r.hmget(f"pdf:{job_id}", META_FIELDS)
+    meta = _decode_meta(dict(zip(META_FIELDS, values)))
     
-    if not meta_data:
+    if not meta:
         raise HTTPException(
             status_code=404,
             detail="Job no encontrado o expirado"
         )
     
-    meta = json.loads(meta_data)
     return meta
 
 
+@app.get("/jobs")
+async def list_jobs(ids: list[str] = Query(...)):
+    """
+    Consulta el estado de varios jobs a la vez.
+    La metadata de todos se lee en un único pipeline en lugar de una
+    petición por job.
+    """
+    if len(ids) > MAX_JOB_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Demasiados jobs. Máximo permitido: {MAX_JOB_IDS}"
+        )
+    
+    with r.pipeline(transaction=False) as pipe:
+        for job_id in ids:
+            pipe.hmget(f"pdf:{job_id}", META_FIELDS)
+        all_values = pipe.execute()
+    jobs = Job.fetch_many(ids, connection=r)
+    
+    results = []
+    for job_id, values, job in zip(ids, all_values, jobs):
+        meta = _decode_meta(dict(zip(META_FIELDS, values)))
+        if not meta and job is None:
+            results.append({"job_id": job_id, "status": "not_found"})
+            continue
+        # Sin metadata el worker todavía no ha tomado el job
+        meta = meta or {"status": "queued"}
+        if job is not None:
+            meta["rq_status"] = job.get_status(refresh=False)
+        results.append({"job_id": job_id, **meta})
+    
+    return {"jobs": results}
+
+
 @app.get("/job-result/{job_id}")
 async def get_job_result(job_id: str):
     """
@@ -133,17 +340,15 @@ async def get_job_result(job_id: str):
     Si el job solicitó base64, devuelve JSON con el PDF en base64.
     Si no, devuelve el PDF directamente.
     """
-    meta_key = f"pdf_meta:{job_id}"
-    result_key = f"pdf_result:{job_id}"
-    
-    meta_data = r.get(meta_key)
-    if not meta_data:
+    # Metadata y PDF en un solo round-trip
+    data = r.hgetall(f"pdf:{job_id}")
+    if not data:
         raise HTTPException(
             status_code=404,
             detail="Job no encontrado o expirado"
         )
     
-    meta = json.loads(meta_data)
+    meta = _decode_meta(data)
     
     if meta["status"] == "processing":
         raise HTTPException(
@@ -161,33 +366,30 @@ async def get_job_result(job_id: str):
         )
     
     # El job está completado
-    result_data = r.get(result_key)
+    result_data = data.get(b"pdf")
     if not result_data:
         raise HTTPException(
             status_code=404,
             detail="Resultado no encontrado"
         )
     
-    pdf_b64 = result_data.decode()
-    
-    # Si se solicitó base64, devolver JSON
+    # Si se solicitó base64, codificar al responder y devolver JSON
     if meta.get("as_base64", False):
         return {
             "job_id": job_id,
             "filename": meta.get("filename", "document.pdf"),
-            "pdf_base64": pdf_b64,
+            "pdf_base64": pybase64.b64encode_as_string(result_data),
             "status": "completed"
         }
     
-    # Si no, devolver el PDF directamente
-    pdf_bytes = base64.b64decode(pdf_b64)
+    # Si no, devolver el PDF directamente (ya está completo en memoria)
     filename = meta.get("filename", "document.pdf")
     # Cambiar extensión a .pdf si no lo es
     if not filename.lower().endswith('.pdf'):
         filename = os.path.splitext(filename)[0] + '.pdf'
     
-    return StreamingResponse(
-        BytesIO(pdf_bytes),
+    return Response(
+        content=result_data,
         media_type="application/pdf",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
@@ -198,10 +400,10 @@ async def delete_job(job_id: str):
     """
     Elimina un job y sus resultados de Redis.
     """
-    meta_key = f"pdf_meta:{job_id}"
-    result_key = f"pdf_result:{job_id}"
+    job_key = f"pdf:{job_id}"
+    input_key = f"pdf_input:{job_id}"
     
-    deleted = r.delete(meta_key, result_key)
+    deleted = r.delete(job_key, input_key)
     
     if deleted == 0:
         raise HTTPException(
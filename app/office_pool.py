@@ -0,0 +1,155 @@
+import os, fcntl, socket, subprocess, tempfile, threading, time
+from contextlib import contextmanager
+
+# Pool de procesos LibreOffice "calientes", cada uno con su puerto y perfil
+LO_HOST = "127.0.0.1"
+LO_BASE_PORT = int(os.environ.get("LO_PORT", "2002"))
+# Un listener por conversión simultánea; el worker RQ clásico ejecuta un job
+# a la vez, así que por defecto basta con uno
+LO_POOL_SIZE = max(1, int(os.environ.get("LO_POOL_SIZE", "1")))
+LO_STARTUP_TIMEOUT = int(os.environ.get("LO_STARTUP_TIMEOUT", "30"))
+LO_HEALTHCHECK_INTERVAL = int(os.environ.get("LO_HEALTHCHECK_INTERVAL", "10"))
+
+
+class OfficeListener:
+    """
+    Proceso soffice headless que acepta conexiones UNO en un puerto.
+    Cada listener usa su propio perfil de usuario para no chocar con el
+    bloqueo de instancia única de LibreOffice.
+    """
+
+    def __init__(self, port: int, host: str = LO_HOST):
+        self.host = host
+        self.port = port
+        self.profile_dir = os.path.join(tempfile.gettempdir(), f"lo-{port}")
+        self.lock_path = f"{self.profile_dir}.lock"
+        self.proc = None
+        # PID del proceso que lanzó soffice; solo ese puede vigilarlo y
+        # reiniciarlo (los work-horses de RQ son forks que no son su padre)
+        self.owner_pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self) -> str:
+        return f"socket,host={self.host},port={self.port};urp;StarOffice.ComponentContext"
+
+    def start(self):
+        self.proc = subprocess.Popen([
+            "soffice", "--headless", "--invisible",
+            f"--accept=socket,host={self.host},port={self.port};urp;",
+            "--norestart", "--nologo", "--nodefault", "--nofirststartwizard",
+            f"-env:UserInstallation=file://{self.profile_dir}"
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.owner_pid = os.getpid()
+        self._wait_ready()
+
+    def _wait_ready(self):
+        deadline = time.monotonic() + LO_STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.is_alive():
+                return
+            if self.proc.poll() is not None:
+                break
+            time.sleep(0.2)
+        raise RuntimeError(f"LibreOffice no respondió en el puerto {self.port}")
+
+    def answers(self) -> bool:
+        """Comprueba que el puerto UNO acepta conexiones."""
+        try:
+            with socket.create_connection((self.host, self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def is_alive(self) -> bool:
+        if self.proc is None or self.proc.poll() is not None:
+            return False
+        return self.answers()
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try: self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired: self.proc.kill()
+        self.proc = None
+
+    def ensure_running(self):
+        if self.owner_pid is not None and self.owner_pid != os.getpid():
+            # En un fork el Popen no es hijo nuestro (poll() daría ECHILD) y
+            # el lock pudo copiarse tomado: solo comprobar el socket y dejar
+            # los reinicios al healthcheck del proceso padre. Si no responde
+            # se espera lo que el padre tarda como mucho en detectarlo y
+            # reiniciarlo antes de dar el job por fallido
+            deadline = time.monotonic() + LO_HEALTHCHECK_INTERVAL + LO_STARTUP_TIMEOUT
+            while not self.answers():
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"LibreOffice no responde en el puerto {self.port}")
+                time.sleep(0.2)
+            return
+        with self._lock:
+            if not self.is_alive():
+                if self.proc is not None:
+                    print(f"[LibreOffice] Listener en puerto {self.port} caído, reiniciando")
+                self.stop()
+                self.start()
+
+
+class OfficePool:
+    """
+    Conjunto de listeners LibreOffice. Cada conversión toma uno con
+    checkout() y lo devuelve al terminar, de modo que hasta `size`
+    conversiones pueden correr en paralelo. La reserva usa un flock por
+    listener, así que funciona también entre procesos (los work-horses de
+    RQ son forks del proceso que arrancó el pool).
+    """
+
+    def __init__(self, size: int = LO_POOL_SIZE, base_port: int = LO_BASE_PORT):
+        self.listeners = [OfficeListener(base_port + i) for i in range(size)]
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            for listener in self.listeners:
+                listener.ensure_running()
+            threading.Thread(target=self._healthcheck_loop, daemon=True).start()
+            self._started = True
+
+    def _healthcheck_loop(self):
+        while True:
+            time.sleep(LO_HEALTHCHECK_INTERVAL)
+            for listener in self.listeners:
+                try: listener.ensure_running()
+                except Exception as e: print(f"[LibreOffice] Error reiniciando listener {listener.port}: {e}")
+
+    def _acquire(self, listener=None):
+        """Reserva un listener libre (o el indicado) y devuelve (listener, fd)."""
+        if listener is not None:
+            fd = os.open(listener.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            return listener, fd
+        while True:
+            for candidate in self.listeners:
+                fd = os.open(candidate.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return candidate, fd
+                except BlockingIOError:
+                    os.close(fd)
+            time.sleep(0.05)
+
+    @contextmanager
+    def checkout(self, listener=None):
+        self.start()
+        listener, fd = self._acquire(listener)
+        try:
+            listener.ensure_running()
+            yield listener
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+pool = OfficePool()
@@ -0,0 +1,25 @@
+import os, socket
+import redis
+
+REDIS_POOL_SIZE = int(os.environ.get("REDIS_POOL_SIZE", "32"))
+REDIS_POOL_TIMEOUT = int(os.environ.get("REDIS_POOL_TIMEOUT", "20"))
+
+
+def make_redis(url: str, max_connections: int = REDIS_POOL_SIZE) -> redis.Redis:
+    """
+    Crea un cliente Redis sobre un BlockingConnectionPool acotado, con
+    keepalive y health checks, para reutilizar conexiones en vez de abrir
+    una nueva bajo carga.
+    """
+    keepalive_options = {}
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        keepalive_options[socket.TCP_KEEPIDLE] = 60
+    pool = redis.BlockingConnectionPool.from_url(
+        url,
+        max_connections=max_connections,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_keepalive=True,
+        socket_keepalive_options=keepalive_options,
+        health_check_interval=30
+    )
+    return redis.Redis(connection_pool=pool)
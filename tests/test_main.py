@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fakeredis
+import pytest
+from fastapi.testclient import TestClient
+from rq import Queue
+from rq.job import Job
+
+from app import main
+
+
+@pytest.fixture
+def redis_conn(monkeypatch):
+    conn = fakeredis.FakeRedis()
+    monkeypatch.setattr(main, "r", conn)
+    monkeypatch.setattr(main, "q", Queue("pdf_jobs", connection=conn))
+    return conn
+
+
+@pytest.fixture
+def client(redis_conn):
+    # Sin context manager: no se ejecutan los eventos de startup (pool de render)
+    return TestClient(main.app)
+
+
+def test_generate_pdf_async_enqueues_job_with_input(client, redis_conn):
+    response = client.post(
+        "/generate-pdf-async",
+        files={"file": ("documento.html", b"<p>Hola</p>", "text/html")},
+        data={"as_base64": "true"}
+    )
+    
+    assert response.status_code == 200
+    body = response.json()
+    job_id = body["job_id"]
+    assert body["filename"] == "documento.html"
+    assert body["status_url"] == f"/job-status/{job_id}"
+    
+    # El contenido va en su propia clave, no en el payload del job
+    input_key = f"pdf_input:{job_id}"
+    assert redis_conn.get(input_key) == b"<p>Hola</p>"
+    
+    job = Job.fetch(job_id, connection=redis_conn)
+    assert job.args == ({"filename": "documento.html", "input_key": input_key, "as_base64": True},)
+    assert main.q.job_ids == [job_id]
+    
+    # Job y entrada expiran a la vez
+    assert job.ttl == main.JOB_TTL
+    assert 0 < redis_conn.ttl(input_key) <= main.JOB_TTL
+
+
+def test_generate_pdf_async_rejects_oversized_file(client, redis_conn, monkeypatch):
+    monkeypatch.setattr(main, "MAX_FILE_SIZE", 4)
+    
+    response = client.post(
+        "/generate-pdf-async",
+        files={"file": ("documento.html", b"<p>Hola</p>", "text/html")}
+    )
+    
+    assert response.status_code == 413
+    assert main.q.count == 0
+
+
+def test_list_jobs_rejects_too_many_ids(client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_JOB_IDS", 2)
+    
+    response = client.get("/jobs", params={"ids": ["a", "b", "c"]})
+    
+    assert response.status_code == 400
+
+
+class _BrokenPool:
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool("un proceso de render murió")
+    
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+
+def test_generate_pdf_rebuilds_broken_render_pool(client, monkeypatch):
+    broken = _BrokenPool()
+    monkeypatch.setattr(main, "render_pool", broken)
+    monkeypatch.setattr(main, "_new_render_pool", lambda: ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(main, "html_to_pdf_bytes", lambda html: b"%PDF-1.7")
+    
+    response = client.post("/generate-pdf", json={"html": "<p>Hola</p>"})
+    
+    assert response.status_code == 200
+    assert response.content == b"%PDF-1.7"
+    assert broken.shut_down
+    assert main.render_pool is not broken
+    main.render_pool.shutdown()
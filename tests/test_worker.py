@@ -0,0 +1,108 @@
+from datetime import timedelta
+
+import fakeredis
+import pytest
+from redis.exceptions import ConnectionError as RedisConnectionError
+from rq import Queue, intermediate_queue
+from rq.job import JobStatus
+from rq.utils import now
+
+from worker import worker
+
+
+@pytest.fixture
+def redis_conn(monkeypatch):
+    conn = fakeredis.FakeRedis()
+    monkeypatch.setattr(worker, "redis_conn", conn)
+    return conn
+
+
+def test_process_job_deletes_input_on_success(redis_conn, monkeypatch):
+    monkeypatch.setattr(worker, "render_html", lambda html: b"%PDF-1.7")
+    redis_conn.set("pdf_input:j1", b"<p>Hola</p>")
+    
+    worker.process_job({"filename": "doc.html", "input_key": "pdf_input:j1"}, job_id="j1")
+    
+    assert redis_conn.hget("pdf:j1", "status") == b"done"
+    assert redis_conn.hget("pdf:j1", "pdf") == b"%PDF-1.7"
+    assert not redis_conn.exists("pdf_input:j1")
+
+
+def test_process_job_keeps_input_on_failure(redis_conn, monkeypatch):
+    def fail(content, filename):
+        raise RuntimeError("LibreOffice no responde")
+    monkeypatch.setattr(worker, "libreoffice_convert_mmap", fail)
+    redis_conn.set("pdf_input:j2", b"docx", ex=60)
+    
+    with pytest.raises(RuntimeError):
+        worker.process_job({"filename": "doc.docx", "input_key": "pdf_input:j2"}, job_id="j2")
+    
+    # La entrada sigue ahí (con su TTL) para poder reencolar el job
+    assert redis_conn.hget("pdf:j2", "status") == b"failed"
+    assert redis_conn.get("pdf_input:j2") == b"docx"
+    assert redis_conn.ttl("pdf_input:j2") > 0
+
+
+def test_process_job_caches_only_self_contained_html(redis_conn, monkeypatch):
+    monkeypatch.setattr(worker, "PDF_CACHE_TTL", 60)
+    monkeypatch.setattr(worker, "render_html", lambda html: b"%PDF-1.7")
+    external = '<img src="https://example.com/logo.png">'
+    for job_id, html in (("j3", "<p>Hola</p>"), ("j4", external)):
+        redis_conn.set(f"pdf_input:{job_id}", html.encode())
+        worker.process_job({"filename": "doc.html", "input_key": f"pdf_input:{job_id}"}, job_id=job_id)
+    
+    assert redis_conn.get(f"pdf_cache:{worker.html_cache_key('<p>Hola</p>')}") == b"%PDF-1.7"
+    assert not redis_conn.exists(f"pdf_cache:{worker.html_cache_key(external)}")
+
+
+@pytest.fixture
+def buffered_worker(redis_conn):
+    queue = Queue("pdf_jobs", connection=redis_conn)
+    w = worker.BufferedWorker([queue], connection=redis_conn, prefetch=3)
+    # fakeredis dice ser Redis 5; el prefetch necesita LMOVE (>= 6.2)
+    w.redis_server_version = (7, 0, 0)
+    return w, queue
+
+
+def test_prefetch_drops_jobs_failed_by_intermediate_cleanup(buffered_worker, redis_conn, monkeypatch):
+    w, queue = buffered_worker
+    j1, j2, j3 = (queue.enqueue(len, "x") for _ in range(3))
+    
+    # El primer dequeue mueve los tres a la cola intermedia y ejecuta el
+    # mantenimiento, que los registra como vistos por primera vez
+    job, _ = w.dequeue_job_and_maintain_ttl(timeout=1)
+    assert job.id == j1.id
+    redis_conn.lrem(queue.intermediate_queue_key, 1, j1.id)  # prepare_job_execution
+    
+    # Una limpieza más de un minuto después da por atascados j2 y j3
+    later = now() + timedelta(minutes=2)
+    monkeypatch.setattr(intermediate_queue, "now", lambda: later)
+    queue.intermediate_queue.cleanup(w, queue)
+    assert j2.get_status() == JobStatus.FAILED
+    
+    # El worker los descarta y sigue con el siguiente job de la cola
+    j4 = queue.enqueue(len, "x")
+    job, _ = w.dequeue_job_and_maintain_ttl(timeout=1)
+    assert job.id == j4.id
+    assert not w._buffer
+    assert j3.get_status() == JobStatus.FAILED
+
+
+def test_prefetch_retries_when_redis_drops(buffered_worker, monkeypatch):
+    w, queue = buffered_worker
+    job = queue.enqueue(len, "x")
+    fill_buffer = w._fill_buffer
+    calls = []
+    
+    def flaky_fill_buffer():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RedisConnectionError("Connection refused")
+        fill_buffer()
+    monkeypatch.setattr(w, "_fill_buffer", flaky_fill_buffer)
+    monkeypatch.setattr(worker.time, "sleep", lambda seconds: None)
+    
+    dequeued, _ = w.dequeue_job_and_maintain_ttl(timeout=1)
+    
+    assert dequeued.id == job.id
+    assert len(calls) == 2
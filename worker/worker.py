@@ -1,19 +1,168 @@
 import os
-import base64
-import json
+import time
 import traceback
 import sys
+from collections import deque
+from contextlib import nullcontext
 from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError
 from rq import Worker, Queue, Connection
+from rq.job import JobStatus
+from rq.worker import WorkerStatus
 
 # Asegurar que el path está configurado
 sys.path.insert(0, '/app')
 
-from app.converter import html_to_pdf_bytes, libreoffice_convert_bytes
+from app.converter import (
+    html_cache_key, html_is_cacheable, render_html, libreoffice_convert_mmap,
+    start_office_pool, warm_up_html, warm_up_office
+)
+from app.redis_pool import make_redis
 
 REDIS_URL = os.environ.get("REDIS_URL", "redis://redis:6379/0")
-redis_conn = Redis.from_url(REDIS_URL)
+# Pool para las escrituras de los jobs; el bucle de RQ (BLPOP bloqueante)
+# usa su propia conexión dedicada para no ocupar una del pool
+redis_conn = make_redis(REDIS_URL)
+queue_conn = Redis.from_url(REDIS_URL)
 RESULT_TTL = int(os.environ.get("JOB_TTL_SECONDS", "3600"))
+# TTL de la caché compartida de PDFs renderizados desde HTML (0 = desactivada).
+# Desactivada por defecto: sin tope de tamaño, con HTML casi siempre distinto
+# (facturas, etc.) solo duplicaría cada resultado en la memoria de Redis
+PDF_CACHE_TTL = int(os.environ.get("PDF_CACHE_TTL_SECONDS", "0"))
+# Jobs que el worker saca de la cola de una vez (1 = comportamiento normal de RQ)
+WORKER_PREFETCH = max(1, int(os.environ.get("WORKER_PREFETCH", "1")))
+
+
+# Extensiones que se convierten con WeasyPrint; el resto va a LibreOffice
+HTML_EXTENSIONS = frozenset((".html", ".htm"))
+
+
+def _file_ext(filename: str) -> str:
+    """Extensión en minúsculas (con el punto), sin pasar por os.path."""
+    _, dot, ext = filename.rpartition(".")
+    return "." + ext.lower() if dot else ""
+
+
+class BufferedWorker(Worker):
+    """
+    Worker RQ que, cuando hay jobs esperando, mueve hasta `prefetch` de la
+    cola a la cola intermedia de RQ con LMOVE en un único pipeline y los
+    carga con Job.fetch_many, sirviendo los siguientes desde memoria. Con la
+    cola vacía espera con el dequeue normal de RQ.
+
+    Los jobs prefetcheados siguen en la cola intermedia hasta que empiezan,
+    así que si el worker muere la limpieza de registros de RQ los recupera
+    igual que con un worker normal. Esa misma limpieza (la de cualquier
+    worker) marca como fallido un job que lleve más de un minuto en la cola
+    intermedia sin empezar, así que `prefetch` multiplicado por la duración
+    de un job debe quedar muy por debajo de un minuto. Antes de ejecutar un
+    job del buffer se comprueba que sigue pendiente y, si no, se descarta.
+    """
+    
+    def __init__(self, *args, prefetch: int = WORKER_PREFETCH, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prefetch = prefetch
+        self._buffer = deque()
+    
+    def _can_prefetch(self) -> bool:
+        # RQ solo usa (y limpia) la cola intermedia con una única cola y
+        # Redis >= 6.2; en otro caso se conserva el dequeue estándar
+        return (
+            self.prefetch > 1
+            and len(self.queues) == 1
+            and self.get_redis_server_version() >= (6, 2, 0)
+        )
+    
+    def _fill_buffer(self):
+        queue = self.queues[0]
+        with self.connection.pipeline(transaction=False) as pipe:
+            for _ in range(self.prefetch):
+                pipe.lmove(queue.key, queue.intermediate_queue_key)
+            job_ids = [job_id.decode() for job_id in pipe.execute() if job_id is not None]
+        if not job_ids:
+            return
+        
+        jobs = self.job_class.fetch_many(job_ids, connection=self.connection, serializer=self.serializer)
+        with self.connection.pipeline(transaction=False) as pipe:
+            for job_id, job in zip(job_ids, jobs):
+                if job is None:
+                    # Job borrado mientras esperaba en la cola
+                    pipe.lrem(queue.intermediate_queue_key, 1, job_id)
+                else:
+                    self._buffer.append((job, queue))
+            pipe.execute()
+    
+    def _next_buffered(self):
+        """Saca del buffer el siguiente job que siga pendiente, o None."""
+        while self._buffer:
+            job, queue = self._buffer.popleft()
+            with self.connection.pipeline(transaction=False) as pipe:
+                pipe.lpos(queue.intermediate_queue_key, job.id)
+                pipe.hget(job.key, "status")
+                position, status = pipe.execute()
+            if position is not None and status is not None and status.decode() == JobStatus.QUEUED:
+                return job, queue
+            # La limpieza de la cola intermedia lo dio por atascado, o se
+            # canceló, borró o reencoló mientras esperaba en el buffer
+            if position is not None:
+                self.connection.lrem(queue.intermediate_queue_key, 1, job.id)
+            self.log.info('%s: %s descartado del prefetch, ya no está pendiente', queue.name, job.id)
+        return None
+    
+    def _dequeue_buffered(self):
+        if not self._buffer and self._can_prefetch():
+            self._fill_buffer()
+        if not self._buffer:
+            return None
+        
+        self.set_state(WorkerStatus.IDLE)
+        self.heartbeat()
+        if self.should_run_maintenance_tasks:
+            self.run_maintenance_tasks()
+        
+        result = self._next_buffered()
+        if result is not None:
+            job, queue = result
+            self.reorder_queues(reference_queue=queue)
+            job.redis_server_version = self.get_redis_server_version()
+            self.log.info('%s: %s (prefetch)', queue.name, job.id)
+        return result
+    
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        # Mismo reintento con backoff que el dequeue de RQ ante caídas de Redis
+        connection_wait_time = 1.0
+        while True:
+            try:
+                result = self._dequeue_buffered()
+                break
+            except RedisConnectionError as conn_err:
+                self.log.error(
+                    'Could not connect to Redis instance: %s Retrying in %d seconds...', conn_err, connection_wait_time
+                )
+                time.sleep(connection_wait_time)
+                connection_wait_time = min(
+                    connection_wait_time * self.exponential_backoff_factor, self.max_connection_wait_time
+                )
+        if result is None:
+            return super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+        return result
+    
+    def _requeue_buffer(self):
+        """Devuelve al frente de su cola los jobs prefetcheados sin procesar."""
+        if not self._buffer:
+            return
+        with self.connection.pipeline() as pipe:
+            for job, queue in reversed(self._buffer):
+                pipe.lrem(queue.intermediate_queue_key, 1, job.id)
+                pipe.lpush(queue.key, job.id)
+            pipe.execute()
+        self._buffer.clear()
+    
+    def work(self, *args, **kwargs):
+        try:
+            return super().work(*args, **kwargs)
+        finally:
+            self._requeue_buffer()
 
 
 def process_job(payload, job_id=None):
@@ -21,7 +170,7 @@ def process_job(payload, job_id=None):
     Procesa un job de conversión a PDF.
     
     Args:
-        payload: Dict con 'filename', 'content_b64', y opcionalmente 'as_base64'
+        payload: Dict con 'filename', 'input_key', y opcionalmente 'as_base64'
         job_id: ID del job (opcional, lo obtiene RQ automáticamente)
     """
     # Si job_id no se pasa, intentar obtenerlo del contexto RQ
@@ -30,56 +179,76 @@ def process_job(payload, job_id=None):
         job = get_current_job()
         job_id = job.id if job else "unknown"
     
-    meta_key = f"pdf_meta:{job_id}"
-    result_key = f"pdf_result:{job_id}"
+    # Metadata y resultado viven en un único hash por job
+    job_key = f"pdf:{job_id}"
     
     try:
-        # Actualizar estado a "processing"
-        redis_conn.set(
-            meta_key,
-            json.dumps({"status": "processing"}),
-            ex=RESULT_TTL
-        )
-        
         # Extraer información del payload
         filename = payload.get("filename", "document")
-        content_b64 = payload.get("content_b64")
+        input_key = payload.get("input_key")
         as_base64 = payload.get("as_base64", False)
         
-        if not content_b64:
-            raise ValueError("Falta 'content_b64' en el payload")
+        if not input_key:
+            raise ValueError("Falta 'input_key' en el payload")
         
-        # Decodificar contenido
-        content = base64.b64decode(content_b64)
+        # Actualizar estado a "processing" y recuperar el contenido de
+        # entrada en un solo round-trip. La entrada solo se borra cuando el
+        # job termina bien; si falla expira con el TTL del job y se puede
+        # reencolar
+        with redis_conn.pipeline(transaction=False) as pipe:
+            pipe.delete(job_key)
+            pipe.hset(job_key, "status", "processing")
+            pipe.expire(job_key, RESULT_TTL)
+            pipe.get(input_key)
+            content = pipe.execute()[-1]
+        
+        if content is None:
+            raise ValueError("Contenido de entrada no encontrado o expirado")
         
         # Determinar tipo de conversión según extensión
-        ext = os.path.splitext(filename)[1].lower()
+        ext = _file_ext(filename)
         
         print(f"[Worker] Procesando archivo: {filename} (extensión: {ext})")
         
-        if ext in (".html", ".htm"):
-            # Conversión HTML a PDF con WeasyPrint
+        # Clave de caché a rellenar si el PDF se renderiza en este job
+        cache_key = None
+        
+        if ext in HTML_EXTENSIONS:
+            # Conversión HTML a PDF con WeasyPrint, reutilizando el PDF de
+            # un HTML idéntico si otro worker ya lo renderizó
             html_string = content.decode("utf-8", errors="ignore")
-            pdf_bytes = html_to_pdf_bytes(html_string)
+            pdf_bytes = None
+            if PDF_CACHE_TTL > 0 and html_is_cacheable(html_string):
+                cache_key = f"pdf_cache:{html_cache_key(html_string)}"
+                pdf_bytes = redis_conn.get(cache_key)
+            if pdf_bytes is not None:
+                cache_key = None
+            else:
+                # Cada job corre en un fork nuevo: la caché en proceso nunca
+                # acertaría, así que se renderiza directamente
+                pdf_bytes = render_html(html_string)
+            pdf_source = nullcontext(pdf_bytes)
         else:
-            # Conversión con LibreOffice para DOCX, ODT, etc.
-            pdf_bytes = libreoffice_convert_bytes(content, filename)
-        
-        # Guardar resultado en Redis como base64
-        pdf_b64 = base64.b64encode(pdf_bytes).decode()
-        redis_conn.set(result_key, pdf_b64, ex=RESULT_TTL)
-        
-        # Actualizar metadata a "done"
-        redis_conn.set(
-            meta_key,
-            json.dumps({
-                "status": "done",
-                "filename": filename,
-                "as_base64": as_base64,
-                "size_bytes": len(pdf_bytes)
-            }),
-            ex=RESULT_TTL
-        )
+            # Conversión con LibreOffice para DOCX, ODT, etc. El PDF se
+            # envía a Redis directamente desde el mmap del archivo de salida
+            pdf_source = libreoffice_convert_mmap(content, filename)
+        
+        with pdf_source as pdf_data:
+            # Guardar resultado (bytes crudos) y metadata "done", y descartar
+            # la entrada, en un solo round-trip
+            with redis_conn.pipeline(transaction=False) as pipe:
+                pipe.hset(job_key, mapping={
+                    "status": "done",
+                    "filename": filename,
+                    "as_base64": "1" if as_base64 else "0",
+                    "size_bytes": len(pdf_data),
+                    "pdf": pdf_data
+                })
+                pipe.expire(job_key, RESULT_TTL)
+                pipe.delete(input_key)
+                if cache_key:
+                    pipe.set(cache_key, pdf_data, ex=PDF_CACHE_TTL)
+                pipe.execute()
         
         print(f"[Worker] Job {job_id} completado exitosamente")
         
@@ -91,16 +260,16 @@ def process_job(payload, job_id=None):
         print(f"[Worker] Error en job {job_id}: {error_msg}")
         print(tb)
         
-        # Guardar error en Redis
-        redis_conn.set(
-            meta_key,
-            json.dumps({
+        # Guardar error en Redis y descartar cualquier resultado previo
+        with redis_conn.pipeline(transaction=False) as pipe:
+            pipe.hdel(job_key, "pdf")
+            pipe.hset(job_key, mapping={
                 "status": "failed",
                 "error": error_msg,
                 "trace": tb
-            }),
-            ex=RESULT_TTL
-        )
+            })
+            pipe.expire(job_key, RESULT_TTL)
+            pipe.execute()
         
         # Re-lanzar la excepción para que RQ la registre
         raise
@@ -111,11 +280,21 @@ if __name__ == "__main__":
     print(f"[Worker] TTL de resultados: {RESULT_TTL} segundos")
     
     try:
-        with Connection(redis_conn):
+        start_office_pool()
+        print("[Worker] Pool de LibreOffice iniciado")
+        # Pagar el arranque en frío de WeasyPrint y LibreOffice antes del
+        # primer job; los work-horses de RQ heredan el estado al hacer fork
+        try:
+            warm_up_html()
+            warm_up_office()
+            print("[Worker] WeasyPrint y LibreOffice precalentados")
+        except Exception as e:
+            print(f"[Worker] Error precalentando conversores: {e}")
+        with Connection(queue_conn):
             q = Queue("pdf_jobs")
-            worker = Worker([q], connection=redis_conn)
+            worker = BufferedWorker([q], connection=queue_conn)
             print("[Worker] Worker listo para procesar jobs")
-            print(f"[Worker] Escuchando cola: pdf_jobs")
+            print(f"[Worker] Escuchando cola: pdf_jobs (prefetch: {worker.prefetch})")
             worker.work(with_scheduler=True)
     except KeyboardInterrupt:
         print("\n[Worker] Cerrando worker...")